@@ -28,70 +28,200 @@ Note: This is a minimal, readable implementation for research and education.
 For production, expect to optimize performance and extend rule coverage.
 """
 
-from typing import Dict, Set, Tuple, Callable
+from typing import Dict, Optional, Sequence, Set, Tuple, Callable
 import torch
 from transformers import LogitsProcessor
 
+# Universal POS tags (https://universaldependencies.org/u/pos/) and their integer codes (fit in int8)
+UPOS_TAGS: Tuple[str, ...] = (
+    "ADJ", "ADP", "ADV", "AUX", "CCONJ", "DET", "INTJ", "NOUN", "NUM",
+    "PART", "PRON", "PROPN", "PUNCT", "SCONJ", "SYM", "VERB", "X",
+)
+UPOS_TO_INT: Dict[str, int] = {tag: code for code, tag in enumerate(UPOS_TAGS)}
+PUNCT_CODE = UPOS_TO_INT["PUNCT"]
+X_CODE = UPOS_TO_INT["X"]
+# Extra row of the blocked-token table that blocks nothing (unconstrained batch items)
+NO_CONSTRAINT = len(UPOS_TAGS)
+
+
+def _map_token_upos(upos_mapper: Callable[[int], str], token_id: int) -> int:
+    """UPOS code of one token id; ids the mapper cannot resolve (e.g. lm_head padding) count as "X"."""
+    try:
+        return UPOS_TO_INT.get(upos_mapper(token_id), X_CODE)
+    except LookupError:
+        return X_CODE
+
+
+def build_upos_table(upos_mapper: Callable[[int], str], vocab_size: int) -> torch.Tensor:
+    """
+    Map every token id in the vocabulary to its UPOS code (int8).
+
+    Build it once and pass it to MCU_GuardLogitsProcessor.from_upos_table() to share it
+    between processors instead of sweeping the vocabulary for each one.
+    """
+    return torch.tensor(
+        [_map_token_upos(upos_mapper, token_id) for token_id in range(vocab_size)],
+        dtype=torch.int8,
+    )
+
+
+def _compute_activation(
+    tail_upos: torch.Tensor, min_tokens_after_punct: int
+) -> Tuple[torch.BoolTensor, torch.Tensor]:
+    """
+    MCU detection for a whole batch from the UPOS codes of its trailing tokens.
+
+    Args:
+        tail_upos: (batch, max(2, min_tokens_after_punct)) UPOS codes of the last tokens
+        min_tokens_after_punct: Minimum tokens after punctuation to activate
+
+    Returns:
+        should_activate per batch item, and the last two UPOS codes per batch item
+    """
+    # Activate only if no punctuation falls within the last min_tokens_after_punct tokens;
+    # earlier punctuation cannot change the activation test
+    punct_window = tail_upos[:, tail_upos.shape[1] - min_tokens_after_punct:]
+    should_activate = ~(punct_window == PUNCT_CODE).any(dim=1)
+    return should_activate, tail_upos[:, -2:]
+
+
 class MCU_GuardLogitsProcessor(LogitsProcessor):
     """
     Apply POS-based constraints ONLY after MCU detection.
+    Blocked tokens are set to -inf in place: the `scores` tensor passed in is modified and returned.
 
     Args:
-        upos_mapper: token_id -> UPOS tag (e.g., "NOUN", "VERB")
-        upos_to_token_ids: UPOS -> Set of valid token IDs
-        meta_rules: {(prev_upos, curr_upos): next_expected_upos}
+        upos_mapper: token_id -> UPOS tag (e.g., "NOUN", "VERB"); tags outside UPOS_TAGS count as "X"
+        upos_to_token_ids: UPOS -> Set of valid token IDs (keys must be in UPOS_TAGS)
+        meta_rules: {(prev_upos, curr_upos): next_expected_upos} (tags must be in UPOS_TAGS)
         min_tokens_after_punct: Minimum tokens after punctuation to activate
+        upos_table: Optional precomputed UPOS code (index into UPOS_TAGS) per token id, covering at
+            least the model's vocab size; when given, upos_mapper is not consulted
+        vocab_size: Optional model vocab size (width of scores); when given with upos_mapper, the
+            UPOS table is precomputed here instead of on the first decoding step
     """
 
     def __init__(
         self,
-        upos_mapper: Callable[[int], str],
+        upos_mapper: Optional[Callable[[int], str]],
         upos_to_token_ids: Dict[str, Set[int]],
         meta_rules: Dict[Tuple[str, str], str],
-        min_tokens_after_punct: int = 5
+        min_tokens_after_punct: int = 5,
+        upos_table: Optional[Sequence[int]] = None,
+        vocab_size: Optional[int] = None
     ):
+        if upos_mapper is None and upos_table is None:
+            raise ValueError("Either upos_mapper or upos_table must be provided")
+
+        # Rules and allowed-id sets are matched against UPOS codes, so every tag must be a UPOS tag
+        rule_tags = {
+            upos
+            for (prev_upos, curr_upos), next_upos in meta_rules.items()
+            for upos in (prev_upos, curr_upos, next_upos)
+        }
+        unknown_tags = (rule_tags | set(upos_to_token_ids)) - set(UPOS_TO_INT)
+        if unknown_tags:
+            raise ValueError(
+                f"Tags outside UPOS_TAGS in meta_rules/upos_to_token_ids: {sorted(unknown_tags)}"
+            )
+
         self.upos_mapper = upos_mapper
         self.upos_to_token_ids = upos_to_token_ids
         self.meta_rules = meta_rules
         self.min_tokens_after_punct = min_tokens_after_punct
+        # token_id -> UPOS code (int8) on the host; built from upos_mapper unless given
+        self.upos_table_cpu: Optional[torch.Tensor] = None
+        self._upos_table_given = upos_table is not None
+        if upos_table is not None:
+            codes = torch.as_tensor(upos_table, dtype=torch.long)
+            if codes.numel() and (codes.min() < 0 or codes.max() >= len(UPOS_TAGS)):
+                raise ValueError(f"upos_table codes must index UPOS_TAGS (0 to {len(UPOS_TAGS) - 1})")
+            self.upos_table_cpu = codes.to(torch.int8)
+        elif vocab_size is not None:
+            self.upos_table_cpu = build_upos_table(upos_mapper, vocab_size)
+        # Tables below depend on the vocab size and device of scores, and are built on first call
+        self._tables_for: Optional[Tuple[int, torch.device]] = None
+        # Copy of upos_table_cpu on the scores device, so the per-step lookup never leaves it
+        self.upos_table: Optional[torch.Tensor] = None
+        # UPOS -> whether Fuse 1 (too few allowed tokens) fires; depends only on vocab size
+        self._fuse1_triggered: Dict[str, bool] = {}
+        # (len(UPOS_TAGS) + 1, vocab) -> True where a token is blocked under that expected UPOS
+        self.blocked_table: Optional[torch.BoolTensor] = None
+
+    @classmethod
+    def from_upos_table(
+        cls,
+        upos_table: Sequence[int],
+        upos_to_token_ids: Dict[str, Set[int]],
+        meta_rules: Dict[Tuple[str, str], str],
+        min_tokens_after_punct: int = 5
+    ) -> "MCU_GuardLogitsProcessor":
+        """Build a processor from a precomputed UPOS table instead of an upos_mapper."""
+        return cls(None, upos_to_token_ids, meta_rules, min_tokens_after_punct, upos_table=upos_table)
+
+    def _build_vocab_tables(self, vocab_size: int, device: torch.device) -> None:
+        """Precompute everything that depends on the vocab size and the scores device."""
+        if self._upos_table_given:
+            if self.upos_table_cpu.shape[0] < vocab_size:
+                raise ValueError(
+                    f"upos_table covers {self.upos_table_cpu.shape[0]} token ids but scores have "
+                    f"{vocab_size}; pad it with X_CODE up to the model's vocab size"
+                )
+        elif self.upos_table_cpu is None or self.upos_table_cpu.shape[0] != vocab_size:
+            self.upos_table_cpu = build_upos_table(self.upos_mapper, vocab_size)
+        self.upos_table = self.upos_table_cpu.to(device)
+
+        self._fuse1_triggered = {
+            upos: len(ids) < max(1, vocab_size * 0.001)
+            for upos, ids in self.upos_to_token_ids.items()
+        }
+
+        # Per expected UPOS, which tokens the constraint blocks
+        blocked = torch.ones(len(UPOS_TAGS) + 1, vocab_size, dtype=torch.bool, device=device)
+        blocked[NO_CONSTRAINT] = False
+        for upos, ids in self.upos_to_token_ids.items():
+            blocked[UPOS_TO_INT[upos], torch.as_tensor(list(ids), dtype=torch.long, device=device)] = False
+        self.blocked_table = blocked
+
+        self._tables_for = (vocab_size, device)
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
         batch_size, seq_len = input_ids.shape
         vocab_size = scores.shape[1]
 
-        # If sequence length is less than 2, return original scores directly
-        if seq_len < 2:
+        # Enough tokens for the last two UPOS tags and for the punctuation window
+        tail_len = max(2, self.min_tokens_after_punct)
+
+        # If the sequence is shorter than that, no batch item can activate: return original scores directly
+        if seq_len < tail_len:
             return scores
 
-        # Create a mask initialized to -inf (block all)
-        final_mask = torch.full_like(scores, -float("inf"))
+        if self._tables_for != (vocab_size, scores.device):
+            self._build_vocab_tables(vocab_size, scores.device)
 
-        for batch_idx in range(batch_size):
-            # Reconstruct full UPOS sequence for this batch item (no shared state!)
-            upos_sequence = []
-            tokens_since_punct = 0
+        # Each batch item is judged from its own tail only (no shared state!)
+        # The lookup runs on device; only the small per-item results are copied to the host
+        tail_upos = self.upos_table[input_ids[:, -tail_len:]]
+        activate, last_two_upos = _compute_activation(tail_upos, self.min_tokens_after_punct)
+        activate, last_two_upos = activate.tolist(), last_two_upos.tolist()
+
+        if not any(activate):
+            return scores
 
-            for i in range(seq_len):
-                token_id = input_ids[batch_idx, i].item()
-                upos = self.upos_mapper(token_id)
-                upos_sequence.append(upos)
+        # Top-1 logit per batch item for Fuse 2, in one reduction and one device-to-host copy
+        top_vals, top_ids = scores.max(dim=-1)
+        top_vals, top_ids = top_vals.tolist(), top_ids.tolist()
 
-                # Count tokens since last punctuation (for activation threshold)
-                if upos == "PUNCT":
-                    tokens_since_punct = 0
-                else:
-                    tokens_since_punct += 1
+        # Expected UPOS code per batch item, or NO_CONSTRAINT
+        constrained_upos = [NO_CONSTRAINT] * batch_size
 
+        for batch_idx in range(batch_size):
             # Check if we should activate constraints
-            should_activate = (
-                tokens_since_punct >= self.min_tokens_after_punct and
-                seq_len >= 2
-            )
+            should_activate = activate[batch_idx]
 
             if should_activate:
                 # Get last two UPOS tags
-                upos_t_minus_2 = upos_sequence[-2]
-                upos_t_minus_1 = upos_sequence[-1]
+                upos_t_minus_2, upos_t_minus_1 = (UPOS_TAGS[code] for code in last_two_upos[batch_idx])
 
                 # Look up expected next UPOS
                 expected_upos = self.meta_rules.get((upos_t_minus_2, upos_t_minus_1))
@@ -100,23 +230,21 @@ class MCU_GuardLogitsProcessor(LogitsProcessor):
                     allowed_ids = self.upos_to_token_ids.get(expected_upos, set())
 
                     # 🔥 Basic Fuses (Safety Nets)
-                    fuse_triggered = False
-
-                    # Fuse 1: Too few allowed tokens (relative to vocab size)
-                    if len(allowed_ids) < max(1, vocab_size * 0.001):
-                        fuse_triggered = True
+                    # Fuse 1: Too few allowed tokens (relative to vocab size); no allowed tokens at all also fires
+                    fuse_triggered = self._fuse1_triggered.get(expected_upos, True)
 
                     # Fuse 2: Model is extremely confident in a disallowed token
-                    top_token = scores[batch_idx].argmax().item()
-                    if not fuse_triggered and top_token not in allowed_ids and scores[batch_idx, top_token] > 5.0:
+                    top_token = top_ids[batch_idx]
+                    if not fuse_triggered and top_token not in allowed_ids and top_vals[batch_idx] > 5.0:
                         fuse_triggered = True  # 5.0 is example threshold; adjust per model
 
                     if not fuse_triggered and allowed_ids:
-                        # Apply constraint: allow only valid tokens
-                        final_mask[batch_idx, list(allowed_ids)] = scores[batch_idx, list(allowed_ids)]
-                        continue
+                        constrained_upos[batch_idx] = UPOS_TO_INT[expected_upos]
 
-            # If no constraint applied (or fuse triggered), keep original scores
-            final_mask[batch_idx] = scores[batch_idx]
+        if any(code != NO_CONSTRAINT for code in constrained_upos):
+            # Apply constraints in place for the whole batch: block everything but the valid tokens.
+            # Rows with no constraint (or a triggered fuse) hit the NO_CONSTRAINT row and keep their scores.
+            blocked = self.blocked_table[torch.tensor(constrained_upos, device=scores.device)]
+            scores.masked_fill_(blocked, -float("inf"))
 
-        return final_mask
+        return scores